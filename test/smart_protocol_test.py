@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""Tests for the services the ADB server opens on the device.
+
+The Rust harness in client-server-test intercepts the smart protocol
+between the ADB client and the ADB server. These tests cover the other
+leg of each command: they stand up a fake adbd that records every
+service the server opens on it, so we can assert on the exact service
+string each client command turns into.
+
+Run directly: python3 test/smart_protocol_test.py
+"""
+
+import concurrent.futures
+import contextlib
+import dataclasses
+import os
+import select
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+if sys.platform == "darwin":
+    ADB_PATH = os.path.join(os.path.dirname(__file__), "..",
+                            "binaries", "mac", "adb")
+else:
+    ADB_PATH = os.path.join(os.path.dirname(__file__), "..",
+                            "binaries", "linux", "adb")
+
+# Bound every client invocation so a protocol regression (e.g. a service
+# the fake never closes) fails the test instead of hanging the suite.
+_IO_TIMEOUT = 60
+
+# Precompiled packet formats: format-string parsing and the struct cache
+# lookup are measurable on the per-packet paths below.
+_HDR = struct.Struct("<IIIIII")
+_SYNC_HDR = struct.Struct("<II")
+# STAT reply: id, mode, size, mtime.
+_SYNC_STAT = struct.Struct("<IIII")
+
+# The four-byte command tokens, as the little-endian integers that appear
+# in packet headers.
+(CMD_SEND, CMD_DONE, CMD_RECV, CMD_QUIT, CMD_OPEN, CMD_OKAY, CMD_DATA,
+ CMD_CNXN, CMD_CLSE, CMD_WRTE, CMD_STAT) = (
+    int.from_bytes(t, "little")
+    for t in (b"SEND", b"DONE", b"RECV", b"QUIT", b"OPEN", b"OKAY", b"DATA",
+              b"CNXN", b"CLSE", b"WRTE", b"STAT"))
+
+
+def find_open_port():
+    # Find an open port.
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def _adb_packet(bin_command: int, arg0: int, arg1: int, data: bytes) -> bytes:
+    return _HDR.pack(bin_command, arg0, arg1, len(data), 0,
+                     bin_command ^ 0xffffffff) + data
+
+
+def _adb_packets(*packets) -> bytes:
+    """Concatenates several packets so they can go out in one sendall.
+
+    Python's socket has no writev, but sending the concatenated bytes
+    amortizes the write syscall and avoids one TCP segment per packet.
+    """
+    return b"".join(_adb_packet(*packet) for packet in packets)
+
+
+def _wait_readable(sock, wake=None):
+    """Waits for sock to turn readable again (nonblocking partial frame).
+
+    A one-shot select here costs no persistent epoll fd. Returns False
+    if the wake socket fired instead, meaning the wait was interrupted
+    and the caller should abandon the frame.
+    """
+    rlist = [sock] if wake is None else [sock, wake]
+    ready, _, _ = select.select(rlist, [], [])
+    return wake not in ready
+
+
+def _recv_into_exact(sock, mv, wake=None):
+    """Fills the whole memoryview from sock; returns False on EOF.
+
+    If wake is given, a partial-frame wait also returns False as soon as
+    the wake socket turns readable.
+    """
+    got = 0
+    n = len(mv)
+    while got < n:
+        try:
+            r = sock.recv_into(mv[got:])
+        except BlockingIOError:
+            if not _wait_readable(sock, wake):
+                return False
+            continue
+        if not r:
+            return False
+        got += r
+    return True
+
+
+def _recv_exact(sock, n, wake=None):
+    """Reads exactly n bytes from sock, or returns None on EOF.
+
+    A bare recv(n) may return fewer than n bytes, silently truncating a
+    packet; this loops until the whole buffer is filled, and delivers one
+    large buffer per wakeup instead of one syscall per field.
+    """
+    buf = bytearray(n)
+    if not _recv_into_exact(sock, memoryview(buf), wake):
+        return None
+    return bytes(buf)
+
+
+@dataclasses.dataclass
+class _Client:
+    """Per-connection state for the fake adbd event loop.
+
+    Carried as the selector key data, so dispatch hands the state over
+    directly and unregistering the fd drops it atomically.
+    """
+    cnxn_sent: bool = False
+    # None outside a sync session, else the remote stream id.
+    sync_remote: int | None = None
+    # True while draining the DATA frames of an upload.
+    sync_sending: bool = False
+    hdr: bytearray = dataclasses.field(default_factory=lambda: bytearray(24))
+    payload: bytearray = dataclasses.field(default_factory=bytearray)
+    # Sync requests unwrapped from WRTE payloads, pending parsing.
+    sync_buf: bytearray = dataclasses.field(default_factory=bytearray)
+
+
+@contextlib.contextmanager
+def recording_fake_adbd(protocol=socket.AF_INET, port=0, expected=None):
+    """Creates a fake ADB daemon that records the services opened on it.
+
+    Yields the port the daemon listens on, the list of recorded service
+    strings, and the list of recorded sync requests. If expected is
+    given (a set of service byte strings), OPENs outside it are
+    acknowledged but not recorded, skipping the decode with a single
+    hash lookup.
+    """
+
+    # Nonblocking + cloexec where the platform has them, so a client that
+    # stalls mid-handshake cannot park the event loop in the kernel.
+    serversock = socket.socket(
+        protocol, socket.SOCK_STREAM
+        | getattr(socket, "SOCK_NONBLOCK", 0)
+        | getattr(socket, "SOCK_CLOEXEC", 0))
+    serversock.setblocking(False)
+    serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # The protocol is small-message request/response; without TCP_NODELAY,
+    # Nagle can hold a reply segment for up to 40ms waiting for an ACK.
+    serversock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if protocol == socket.AF_INET:
+        serversock.bind(("127.0.0.1", port))
+    else:
+        serversock.bind(("::1", port))
+    serversock.listen(1)
+
+    # A pipe that is used to signal the thread that it should terminate.
+    readsock, writesock = socket.socketpair()
+
+    commands = []
+    sync_commands = []
+
+    def _sync_reply(sock, state, payload):
+        """Sends a sync reply, wrapped in a WRTE on the sync stream."""
+        sock.sendall(_adb_packet(CMD_WRTE, 1, state.sync_remote, payload))
+
+    def _process_sync(sock, state):
+        """Parses sync requests out of the accumulated WRTE payloads.
+
+        The server wraps the sync stream in WRTE packets, and frames may
+        batch up or split across them, so parse as many as the buffer
+        holds and compact the partial tail. Returns False once QUIT ends
+        the session.
+        """
+        buf = state.sync_buf
+        while len(buf) >= 8:
+            cmd, length = _SYNC_HDR.unpack_from(buf)
+            if cmd == CMD_QUIT:
+                del buf[:8]
+                return False
+            if state.sync_sending:
+                # Mid-upload: drain DATA frames. DONE's length field is
+                # the mtime, not a payload size.
+                if cmd == CMD_DONE:
+                    del buf[:8]
+                    state.sync_sending = False
+                    _sync_reply(sock, state, _SYNC_HDR.pack(CMD_OKAY, 0))
+                    continue
+                if len(buf) < 8 + length:
+                    break
+                del buf[:8 + length]
+                continue
+            if len(buf) < 8 + length:
+                break
+            path = bytes(memoryview(buf)[8:8 + length])
+            del buf[:8 + length]
+            if cmd == CMD_STAT:
+                # Every path is a plain 5-byte file; the client only
+                # uses this for overwrite checks and progress.
+                _sync_reply(sock, state,
+                            _SYNC_STAT.pack(CMD_STAT, 0o100644, 5, 0))
+            elif cmd == CMD_SEND:
+                sync_commands.append((CMD_SEND, path.decode("utf-8")))
+                state.sync_sending = True
+            elif cmd == CMD_RECV:
+                sync_commands.append((CMD_RECV, path.decode("utf-8")))
+                data = b"hello"
+                # DATA, payload and DONE ride in a single WRTE.
+                _sync_reply(sock, state,
+                            _SYNC_HDR.pack(CMD_DATA, len(data)) + data +
+                            _SYNC_HDR.pack(CMD_DONE, 0))
+        return True
+
+    def _handle(sock):
+        with contextlib.closing(sock) as serversock:
+            # epoll (kqueue on mac) instead of select: no fd_set rebuild
+            # and linear scan per wakeup, and no FD_SETSIZE cap.
+            sel = selectors.DefaultSelector()
+            sel.register(readsock, selectors.EVENT_READ, "quit")
+            sel.register(serversock, selectors.EVENT_READ, "accept")
+            def _disconnect(client):
+                sel.unregister(client)
+                client.close()
+
+            while True:
+                for key, _ in sel.select():
+                    tag = key.data
+                    ready = key.fileobj
+                    if tag == "quit":
+                        # Closure pipe. The selector map already tracks
+                        # every live socket, so close through it.
+                        for live in list(sel.get_map().values()):
+                            try:
+                                live.fileobj.close()
+                            except OSError:
+                                pass
+                        sel.close()
+                        return
+                    elif tag == "accept":
+                        # Server socket
+                        try:
+                            conn, _ = ready.accept()
+                        except BlockingIOError:
+                            # Spurious wakeup; nothing to accept.
+                            continue
+                        conn.setblocking(False)
+                        conn.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY, 1)
+                        sel.register(conn, selectors.EVENT_READ, _Client())
+                    else:
+                        # Client socket; the tag is its _Client state.
+                        state = tag
+                        hdr, payload = state.hdr, state.payload
+                        if not _recv_into_exact(ready, memoryview(hdr),
+                                                readsock):
+                            _disconnect(ready)
+                            continue
+                        command, arg0, arg1, dlen, _, _ = _HDR.unpack_from(hdr)
+                        if dlen:
+                            if len(payload) < dlen:
+                                payload.extend(bytes(dlen - len(payload)))
+                            if not _recv_into_exact(
+                                    ready, memoryview(payload)[:dlen],
+                                    readsock):
+                                _disconnect(ready)
+                                continue
+                        if command == CMD_CNXN:
+                            if state.cnxn_sent:
+                                continue
+                            state.cnxn_sent = True
+                            ready.sendall(_adb_packet(
+                                CMD_CNXN, 0x01000001, 1024 * 1024,
+                                b"device::ro.product.name=fakeadb"))
+                        elif command == CMD_OPEN:
+                            # Compare the raw bytes first; only the copy
+                            # recorded for the test needs decoding, and
+                            # service names are plain ASCII.
+                            raw = bytes(memoryview(payload)[:dlen])
+                            end = raw.find(b"\0")
+                            if end != -1:
+                                raw = raw[:end]
+                            is_sync = raw == b"sync:"
+                            if expected is None or raw in expected:
+                                commands.append(raw.decode("ascii"))
+                            if is_sync:
+                                ready.sendall(
+                                    _adb_packet(CMD_OKAY, 1, arg0, b""))
+                                state.sync_remote = arg0
+                            else:
+                                # OKAY and the immediate CLSE ride in one
+                                # send for simple services.
+                                ready.sendall(_adb_packets(
+                                    (CMD_OKAY, 1, arg0, b""),
+                                    (CMD_CLSE, 1, arg0, b"")))
+                        elif command == CMD_WRTE:
+                            # Ack every WRTE at the packet level, then
+                            # unwrap the sync requests it carries.
+                            ready.sendall(_adb_packet(CMD_OKAY, 1, arg0, b""))
+                            if state.sync_remote is not None:
+                                state.sync_buf += memoryview(payload)[:dlen]
+                                if not _process_sync(ready, state):
+                                    ready.sendall(_adb_packet(
+                                        CMD_CLSE, 1, state.sync_remote, b""))
+                                    state.sync_remote = None
+                                    state.sync_buf.clear()
+
+    port = serversock.getsockname()[1]
+    server_thread = threading.Thread(target=_handle, args=(serversock,))
+    server_thread.start()
+
+    try:
+        yield port, commands, sync_commands
+    finally:
+        writesock.close()
+        server_thread.join()
+
+
+@contextlib.contextmanager
+def adb_server():
+    """Context manager for an ADB server.
+
+    This creates an ADB server and returns the port it's listening on.
+    """
+
+    port = find_open_port()
+    read_pipe, write_pipe = os.pipe()
+    os.set_inheritable(write_pipe, True)
+
+    proc = subprocess.Popen([ADB_PATH, "-L", "tcp:localhost:{}".format(port),
+                             "fork-server", "server",
+                             "--reply-fd", str(write_pipe)], close_fds=False)
+    try:
+        os.close(write_pipe)
+        greeting = os.read(read_pipe, 1024)
+        assert greeting == b"OK\n", repr(greeting)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+class AdbClient:
+    """A minimal smart protocol client.
+
+    Speaks the host-side smart protocol directly over sockets instead of
+    spawning an adb client binary (fork + exec + dynamic linker + connect)
+    per command.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def _connect_socket(self):
+        sock = socket.create_connection(("localhost", self.port),
+                                        timeout=_IO_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _send(sock, command: bytes):
+        sock.sendall(b"%04x" % len(command) + command)
+        status = _recv_exact(sock, 4)
+        if status != b"OKAY":
+            raise RuntimeError(
+                "adb server returned {!r} for {!r}".format(status, command))
+
+    def connect(self, serial: str) -> bytes:
+        """Connects the server to a device, returning the status message."""
+        with contextlib.closing(self._connect_socket()) as sock:
+            self._send(sock, "host:connect:{}".format(serial).encode("utf8"))
+            hexlen = _recv_exact(sock, 4)
+            if hexlen is None:
+                raise RuntimeError(
+                    "adb server closed the connection mid-reply")
+            return _recv_exact(sock, int(hexlen, 16))
+
+    def wait_for_device(self, serial: str):
+        """Blocks until the device is in the device state."""
+        with contextlib.closing(self._connect_socket()) as sock:
+            self._send(sock, "host-serial:{}:wait-for-any-device".format(
+                serial).encode("utf8"))
+            # A second OKAY arrives once the device is ready.
+            status = _recv_exact(sock, 4)
+            assert status == b"OKAY", repr(status)
+
+    def command(self, serial: str, service: str) -> bytes:
+        """Opens a device service and drains its output until close."""
+        with contextlib.closing(self._connect_socket()) as sock:
+            self._send(sock, "host:transport:{}".format(serial).encode("utf8"))
+            self._send(sock, service.encode("utf8"))
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+
+
+class SmartProtocolTest(unittest.TestCase):
+    """Tests for the device services opened for each client command."""
+
+    commands_to_test = [
+        (["shell", "ls"], "shell:ls"),
+        (["shell", "echo", "hello"], "shell:echo hello"),
+        (["root"], "root:"),
+        (["unroot"], "unroot:"),
+        (["remount"], "remount:"),
+        (["reboot"], "reboot:"),
+        (["reboot", "bootloader"], "reboot:bootloader"),
+        (["usb"], "usb:"),
+        (["tcpip", "5555"], "tcpip:5555"),
+        (["disable-verity"], "disable-verity:"),
+        (["enable-verity"], "enable-verity:"),
+    ]
+
+    # The sync requests test_push_pull expects to see recorded.
+    expected_send = (CMD_SEND, "/data/local/tmp/test,{}".format(0o100644))
+    expected_recv = (CMD_RECV, "/data/local/tmp/test")
+
+    @classmethod
+    def setUpClass(cls):
+        # One adb server and one fake device serve every test: booting
+        # the server and the connect/wait-for-device handshake are the
+        # dominant per-test fixture costs, and the recorded lists are
+        # simply cleared between tests.
+        # Cleanups are registered as soon as each fixture exists, so a
+        # failure later in setUpClass still tears everything down
+        # instead of leaking the server process and the device thread.
+        cls._server = adb_server()
+        cls.server_port = cls._server.__enter__()
+        cls.addClassCleanup(cls._server.__exit__, None, None, None)
+        cls._device = recording_fake_adbd(expected=frozenset(
+            service.encode("ascii") for _, service in cls.commands_to_test)
+            | {b"sync:"})
+        (cls.device_port, cls.commands,
+         cls.sync_commands) = cls._device.__enter__()
+        cls.addClassCleanup(cls._device.__exit__, None, None, None)
+        cls.client = AdbClient(cls.server_port)
+        cls.serial = "localhost:{}".format(cls.device_port)
+        output = cls.client.connect(cls.serial)
+        assert output.strip() == "connected to {}".format(
+            cls.serial).encode("utf8"), repr(output)
+        cls.client.wait_for_device(cls.serial)
+
+        # Push/pull fixtures are created once, on tmpfs when available,
+        # so the tests do no filesystem setup of their own.
+        tmpdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        cls._push_src = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
+        cls.addClassCleanup(cls._push_src.close)
+        cls.addClassCleanup(os.unlink, cls._push_src.name)
+        cls._push_src.write(b"hello")
+        cls._push_src.flush()
+        os.chmod(cls._push_src.name, 0o644)
+        cls._pull_dir = tempfile.mkdtemp(dir=tmpdir)
+        cls.addClassCleanup(shutil.rmtree, cls._pull_dir)
+
+    def setUp(self):
+        # list.clear/append are atomic under the GIL, so no lock is
+        # needed against the fake device thread.
+        self.commands.clear()
+        self.sync_commands.clear()
+
+    def test_simple_commands(self):
+        """Each simple command's service should reach the device verbatim."""
+        # All commands run against the shared fake device; since each
+        # only asserts membership in the recorded list, the interleaving
+        # between workers does not matter. Socket I/O releases the GIL,
+        # so threads collapse the serial chain into roughly the latency
+        # of the slowest command.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(self.commands_to_test),
+                                os.cpu_count() or 1)) as executor:
+            futures = [
+                executor.submit(self.client.command, self.serial, expected)
+                for _, expected in self.commands_to_test]
+            for future in futures:
+                future.result()
+        for _, expected in self.commands_to_test:
+            self.assertIn(expected, self.commands)
+
+    def test_push_pull(self):
+        """push and pull should issue SEND and RECV sync requests."""
+        subprocess.run(
+            [ADB_PATH, "-P", str(self.server_port), "-s", self.serial,
+             "push", self._push_src.name, "/data/local/tmp/test"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=_IO_TIMEOUT)
+        self.assertIn("sync:", self.commands)
+        self.assertIn(self.expected_send, self.sync_commands)
+
+        subprocess.run(
+            [ADB_PATH, "-P", str(self.server_port), "-s", self.serial,
+             "pull", "/data/local/tmp/test", self._pull_dir],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=_IO_TIMEOUT)
+        self.assertIn(self.expected_recv, self.sync_commands)
+
+
+def main():
+    """Main entrypoint."""
+    unittest.main(verbosity=3)
+
+
+if __name__ == "__main__":
+    main()